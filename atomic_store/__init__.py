@@ -15,7 +15,14 @@ See `the README.md <https://github.com/BenWiederhake/atomic_store/blob/master/RE
 for a linear walkthrough for each feature.
 """
 
-from ._impl import AbstractFormatBstr, AbstractFormatFile, AtomicStore, WrapBinaryFormat
+from ._impl import AbstractFormatBstr, AbstractFormatFile, AtomicStore, OutOfBandPickleFormat, WrapBinaryFormat
+from ._impl import open_many
 from ._impl import open_store as open
+from ._pool import PoolStats, StorePool, WriteBackError
+from ._shared import SharedValue
+from ._shared import attach_store as attach
+from ._shared import share_store as share
 
-__all__ = ['AbstractFormatBstr', 'AbstractFormatFile', 'AtomicStore', 'open', 'WrapBinaryFormat']
+__all__ = ['AbstractFormatBstr', 'AbstractFormatFile', 'AtomicStore', 'attach', 'open', 'open_many',
+           'OutOfBandPickleFormat', 'PoolStats', 'share', 'SharedValue', 'StorePool',
+           'WrapBinaryFormat', 'WriteBackError']
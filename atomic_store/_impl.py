@@ -2,9 +2,18 @@
 # MIT license.  See the LICENSE file included in the package.
 # This documentation uses NumPy style.  I recommend numpydoc.
 
+import concurrent.futures
+import concurrent.futures.process
+import copy
+import copyreg
+import io
 import json
+import mmap
+import multiprocessing
 import os.path
 import pickle
+import struct
+import sys
 
 import atomicwrites
 
@@ -19,6 +28,43 @@ def _open_readable(path, is_binary):
     return open(path, mode)
 
 
+def _read_content(path, is_binary):
+    if not os.path.exists(path):
+        return None
+    with _open_readable(path, is_binary) as fp:
+        return fp.read()
+
+
+# From linux/fs.h: _IOW(0x94, 9, int)
+_FICLONE = 0x40049409
+_REFLINK_BLOCK_SIZE = 4096
+
+
+def _clone_into(path, fp):
+    try:
+        import fcntl
+        with open(path, 'rb') as src:
+            fcntl.ioctl(fp.fileno(), _FICLONE, src.fileno())
+    except (ImportError, OSError):
+        # Not Linux, no previous file, or the filesystem can't do reflinks.
+        return False
+    return True
+
+
+def _write_changed_blocks(fp, data, block_size=_REFLINK_BLOCK_SIZE):
+    data = memoryview(data)
+    written = 0
+    for offset in range(0, len(data), block_size):
+        block = data[offset:offset + block_size]
+        fp.seek(offset)
+        if fp.read(len(block)) != block:
+            fp.seek(offset)
+            fp.write(block)
+            written += 1
+    fp.truncate(len(data))
+    return written
+
+
 class AbstractFormatBstr:
     r"""Abstract class for a binary format definition.
 
@@ -96,6 +142,109 @@ class WrapBinaryFormat:
         return self.format_bstr.loads(bstr, **kwargs)
 
 
+_OOB_MAGIC = b'ASPKL5\x00\x01'
+_OOB_HEADER = struct.Struct('<8sQQ')
+_OOB_ENTRY = struct.Struct('<QQ')
+
+
+def _reduce_memoryview(obj):
+    return memoryview, (pickle.PickleBuffer(obj),)
+
+
+class _OutOfBandPickler(pickle.Pickler):
+    # Loaded out-of-band buffers are memoryviews, so they must survive the next commit.
+    dispatch_table = copyreg.dispatch_table.copy()
+    dispatch_table[memoryview] = _reduce_memoryview
+
+
+def _oob_encode(obj, alignment, **kwargs):
+    buffers = []
+    stream = io.BytesIO()
+    _OutOfBandPickler(stream, protocol=5, buffer_callback=buffers.append, **kwargs).dump(obj)
+    data = stream.getbuffer()
+    raws = [buf.raw() for buf in buffers]
+    offset = _OOB_HEADER.size + _OOB_ENTRY.size * len(raws) + len(data)
+    table = []
+    for raw in raws:
+        offset += -offset % alignment
+        table.append((offset, raw.nbytes))
+        offset += raw.nbytes
+    header = _OOB_HEADER.pack(_OOB_MAGIC, len(data), len(raws))
+    header += b''.join(_OOB_ENTRY.pack(*entry) for entry in table)
+    chunks = [(0, header), (len(header), data)]
+    chunks.extend((entry[0], raw) for entry, raw in zip(table, raws))
+    return offset, chunks
+
+
+def _oob_decode(view, readonly=False, **kwargs):
+    magic, data_len, num_buffers = _OOB_HEADER.unpack_from(view, 0)
+    if magic != _OOB_MAGIC:
+        raise ValueError('Not an out-of-band pickle store', magic)
+    table_end = _OOB_HEADER.size + _OOB_ENTRY.size * num_buffers
+    buffers = []
+    for i in range(num_buffers):
+        offset, length = _OOB_ENTRY.unpack_from(view, _OOB_HEADER.size + _OOB_ENTRY.size * i)
+        buf = view[offset:offset + length]
+        buffers.append(buf.toreadonly() if readonly else buf)
+    with view[table_end:table_end + data_len] as data:
+        return pickle.loads(data, buffers=buffers, **kwargs)
+
+
+class OutOfBandPickleFormat(AbstractFormatFile):
+    r"""Pickle protocol 5, with large buffers stored out-of-band.
+
+    Objects that pickle themselves as `pickle.PickleBuffer` (for example
+    NumPy arrays), `pickle.PickleBuffer` objects themselves, and `memoryview`
+    objects are not copied into the pickle stream.  Instead,
+    they are written as-is into aligned regions behind it in the same file.
+    When loading, the file is memory-mapped, and these buffers are handed to
+    `pickle.loads` as `memoryview` objects into the mapping, so their content
+    is never copied.  To store `bytes` or `bytearray` like this, wrap them in a
+    `memoryview`.  Note that `memoryview` objects come back as plain bytes,
+    i.e. their `format` and `shape` are not preserved.
+
+    The mapping is copy-on-write: writing to a loaded buffer is possible,
+    but never changes the file.  It is kept open as long as any loaded
+    buffer is still alive.  Note that on Windows, an open mapping prevents
+    the file from being replaced, so `commit()` fails until the buffers are
+    released.
+
+    Requires Python 3.8 or newer.  Use it with `format='pickle5'`.
+
+    Attributes
+    ----------
+    alignment : int
+        Each out-of-band buffer starts at a multiple of this many bytes
+        into the file.  Defaults to 64.
+
+    Methods
+    -------
+    dump(obj, fp)
+        Encode the object into the given file.
+    load(fp)
+        Decode from the file, mapping the out-of-band buffers.
+    """
+    def __init__(self, alignment=64):
+        if pickle.HIGHEST_PROTOCOL < 5:
+            raise ValueError('pickle5 format not supported (requires Python 3.8)')
+        self.alignment = alignment
+
+    def dump(self, obj, fp, **kwargs):
+        size, chunks = _oob_encode(obj, self.alignment, **kwargs)
+        position = 0
+        for offset, chunk in chunks:
+            fp.write(bytes(offset - position))
+            position = offset + fp.write(chunk)
+        fp.write(bytes(size - position))
+
+    def load(self, fp, **kwargs):
+        mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_COPY)
+        return _oob_decode(memoryview(mapped), **kwargs)
+
+
+_UNSET = object()
+
+
 class AtomicStore:
     r"""Represents a single-value, single-file store with atomic updates.
 
@@ -112,26 +261,34 @@ class AtomicStore:
     format : None or module or str or AbstractFormatBstr or AbstractFormatFile or object
         A format indication
         Supported values are `None` (for JSON), `'json'`, `'pickle'`,
+        `'pickle5'` (see `OutOfBandPickleFormat`),
         `'bson'` (requires bson to be installed), and also any module or object
         providing `dump/load` or `dumps/loads`.
         Note that this means you can use the modules `json`, `pickle`,
         and `bson` as they are.
+    reflink : bool
+        Whether `commit()` clones the previous file and only rewrites the
+        blocks that changed.  See `open_store`.
 
     See also
     --------
     open_store
     """
     def __init__(self, path, default, format, is_binary,
-                 load_kwargs, dump_kwargs, ignore_inner_exits):
+                 load_kwargs, dump_kwargs, ignore_inner_exits, reflink=False, _value=_UNSET):
         self.path = path
         self.format = format
         self.is_binary = is_binary
         self.load_kwargs = load_kwargs
         self.dump_kwargs = dump_kwargs
         self.ignore_inner_exits = ignore_inner_exits
+        self.reflink = reflink
         self.level = 0
 
-        if not os.path.exists(self.path):
+        if _value is not _UNSET:
+            # Already loaded by `open_many`.
+            self.value = _value
+        elif not os.path.exists(self.path):
             self.value = default
         else:
             with _open_readable(self.path, self.is_binary) as fp:
@@ -144,9 +301,29 @@ class AtomicStore:
         either see the previous file content, or the new file content,
         but never an intermediate or even corrupted content.
         """
+        if self.reflink:
+            self._commit_reflinked()
+            return
         with _open_writable(self.path, self.is_binary) as fp:
             self.format.dump(self.value, fp, **self.dump_kwargs)
 
+    def _commit_reflinked(self):
+        with atomicwrites.AtomicWriter(self.path, mode='w+b', overwrite=True).open() as fp:
+            if _clone_into(self.path, fp):
+                buf = io.BytesIO()
+                self._dump_binary(buf)
+                _write_changed_blocks(fp, buf.getbuffer())
+            else:
+                # No need to hold a second copy in memory.
+                self._dump_binary(fp)
+
+    def _dump_binary(self, fp):
+        # Text mode must encode exactly like `_open_writable` would.
+        out = fp if self.is_binary else io.TextIOWrapper(fp)
+        self.format.dump(self.value, out, **self.dump_kwargs)
+        if out is not fp:
+            out.detach()
+
     def __enter__(self):
         r"""Enters a new context.
 
@@ -204,6 +381,8 @@ def resolve_format(format):
         return True, WrapBinaryFormat(_get_bson_module())
     if format == 'pickle':
         return True, pickle
+    if format == 'pickle5':
+        return True, OutOfBandPickleFormat()
     if getattr(format, 'dump', None) and getattr(format, 'load', None):
         return True, format
     if getattr(format, 'dumps', None) and getattr(format, 'loads', None):
@@ -212,7 +391,7 @@ def resolve_format(format):
 
 
 def open_store(path, default=None, format=None, is_binary=None,
-               load_kwargs=None, dump_kwargs=None, ignore_inner_exits=False):
+               load_kwargs=None, dump_kwargs=None, ignore_inner_exits=False, reflink=False):
     r"""Opens a new atomic store.  Main entry point for `atomic_store`.
 
     This opens a new store at the given `path`.  The returned object allows
@@ -229,6 +408,7 @@ def open_store(path, default=None, format=None, is_binary=None,
     format : None or module or str or AbstractFormatBstr or AbstractFormatFile or object
         A format indication
         Supported values are `None` (for JSON), `'json'`, `'pickle'`,
+        `'pickle5'` (see `OutOfBandPickleFormat`),
         `'bson'` (requires bson to be installed), and also any module or object
         providing `dump/load` or `dumps/loads`.
         Note that this means you can use the modules `json`, `pickle`,
@@ -258,7 +438,21 @@ def open_store(path, default=None, format=None, is_binary=None,
         By default (`None` and `False`), the store will save the file in all cases.
         If `True`, the store will only save upon exiting the outermost context,
         thus reducing the chances of seeing "intermediate" values in the file.
+    reflink : bool
+        Intended for large stores on copy-on-write filesystems (like Btrfs or XFS).
+        If `True`, `commit()` clones the current file into the temporary file
+        (using `FICLONE`), and only overwrites the blocks whose encoding changed,
+        before atomically replacing the file as usual.
+        If cloning is not possible (e.g. on tmpfs, ext4, or outside of Linux),
+        this silently falls back to writing the whole file.  Default is `False`.
     """
+    format, is_binary, load_kwargs, dump_kwargs = \
+        _resolve_options(format, is_binary, load_kwargs, dump_kwargs)
+    return AtomicStore(path, default, format, is_binary,
+                       load_kwargs, dump_kwargs, ignore_inner_exits, reflink)
+
+
+def _resolve_options(format, is_binary, load_kwargs, dump_kwargs):
     is_binary_hint, format = resolve_format(format)
     if is_binary is None:
         is_binary = is_binary_hint
@@ -266,5 +460,109 @@ def open_store(path, default=None, format=None, is_binary=None,
         load_kwargs = dict()
     if dump_kwargs is None:
         dump_kwargs = dict()
-    return AtomicStore(path, default, format, is_binary,
-                       load_kwargs, dump_kwargs, ignore_inner_exits)
+    return format, is_binary, load_kwargs, dump_kwargs
+
+
+def _process_format_name(format):
+    # Only these can be resolved again in another process.  Pickle is not
+    # among them: Sending the result back would just pickle it once more.
+    if format is None or format is json or format == 'json':
+        return 'json'
+    if format == 'bson' or getattr(format, '__name__', None) == 'bson':
+        return 'bson'
+    return None
+
+
+def _decode_content(content, format_name, is_binary, load_kwargs):
+    _, format = resolve_format(format_name)
+    fp = io.BytesIO(content) if is_binary else io.StringIO(content)
+    return format.load(fp, **load_kwargs)
+
+
+def open_many(paths, *, max_threads=None, process_threshold=None, default=None, format=None,
+              is_binary=None, load_kwargs=None, dump_kwargs=None, ignore_inner_exits=False,
+              reflink=False):
+    r"""Opens many atomic stores at once, reading the files in parallel.
+
+    This is like calling `open_store` for each path, but overlaps the reads
+    in a thread pool, which helps a lot with slow (e.g. network-backed) disks.
+    Large files can also be decoded in a process pool.
+    For each path, errors are collected instead of aborting the whole batch.
+    All arguments except `paths` must be given by keyword.
+
+    Parameters
+    ----------
+    paths : iterable of str or path
+        Paths to files.  These files may or may not already exist.
+    max_threads : None or int
+        Number of threads reading files.  By default, the default of
+        `concurrent.futures.ThreadPoolExecutor` is used.
+    process_threshold : None or int
+        If set, files with at least this many bytes are decoded in a separate
+        process, so decoding doesn't hold up the other threads.  Only works with
+        the formats `'json'` and `'bson'` on Python 3.7 or newer, and only pays
+        off for large files.  By default (`None`), everything is decoded in the threads.
+        The processes import the calling script's `__main__` module, so the
+        script needs an `if __name__ == '__main__':` guard.  If the processes
+        can't start anyway (e.g. when running code from stdin), the files are
+        decoded in the threads instead.
+    default, format, is_binary, load_kwargs, dump_kwargs, ignore_inner_exits, reflink
+        Same as for `open_store`, and shared by all stores.
+        Missing files are initialized with `default` just like in `open_store`,
+        except that each missing file gets its own copy.
+
+    Returns
+    -------
+    (list, dict)
+        The list contains the constructed stores, in the same order as `paths`,
+        or `None` where opening failed.  The dict maps each path that failed
+        to the exception it raised.
+
+    See also
+    --------
+    open_store
+    """
+    paths = list(paths)
+    format_name = _process_format_name(format)
+    format, is_binary, load_kwargs, dump_kwargs = \
+        _resolve_options(format, is_binary, load_kwargs, dump_kwargs)
+
+    def open_one(path, process_pool):
+        value = _UNSET
+        if process_pool is not None and os.path.exists(path) \
+                and os.path.getsize(path) >= process_threshold:
+            content = _read_content(path, is_binary)
+            if content is not None:
+                try:
+                    future = process_pool.submit(_decode_content, content, format_name,
+                                                 is_binary, load_kwargs)
+                    value = future.result()
+                except concurrent.futures.process.BrokenProcessPool:
+                    value = _decode_content(content, format_name, is_binary, load_kwargs)
+        if value is _UNSET and not os.path.exists(path):
+            value = copy.deepcopy(default)
+        return AtomicStore(path, default, format, is_binary, load_kwargs,
+                           dump_kwargs, ignore_inner_exits, reflink, _value=value)
+
+    stores = [None] * len(paths)
+    errors = dict()
+    process_pool = None
+    # `mp_context` needs Python 3.7.
+    if process_threshold is not None and format_name is not None and sys.version_info >= (3, 7):
+        # The workers are started from within the reader threads, and forking
+        # a multi-threaded process can deadlock.
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        process_pool = concurrent.futures.ProcessPoolExecutor(
+            mp_context=multiprocessing.get_context(start_method))
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_threads) as thread_pool:
+            futures = [thread_pool.submit(open_one, path, process_pool) for path in paths]
+            for i, future in enumerate(futures):
+                try:
+                    stores[i] = future.result()
+                except Exception as e:
+                    errors[paths[i]] = e
+    finally:
+        if process_pool is not None:
+            process_pool.shutdown()
+    return stores, errors
@@ -0,0 +1,238 @@
+# Copyright (c) 2019, Ben Wiederhake
+# MIT license.  See the LICENSE file included in the package.
+# This documentation uses NumPy style.  I recommend numpydoc.
+
+import collections
+import contextlib
+import copy
+import os
+import threading
+
+from ._impl import open_store
+
+
+PoolStats = collections.namedtuple('PoolStats', ['hits', 'misses', 'evictions', 'writebacks'])
+PoolStats.__doc__ = r"""Counters of a `StorePool`.
+
+Attributes
+----------
+hits : int
+    Number of times a store was used while already open.
+misses : int
+    Number of times a store had to be opened (and thus parsed).
+evictions : int
+    Number of stores that were closed to make room.
+writebacks : int
+    Number of commits done by the pool, upon eviction or `flush()`.
+"""
+
+
+class WriteBackError(Exception):
+    r"""Raised when the `StorePool` could not commit some of the stores.
+
+    All other stores were committed regardless.  The failed ones stay open
+    and modified, so nothing is lost; a later `flush()` or `close()` tries again.
+
+    Attributes
+    ----------
+    errors : dict
+        Maps the path of each store that failed to the exception raised by `commit()`.
+    """
+    def __init__(self, errors):
+        super().__init__('Could not write back {} store(s)'.format(len(errors)), errors)
+        self.errors = errors
+
+
+class _Entry:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.store = None
+        self.size = 0
+        self.dirty = False
+        self.users = 0
+
+
+class StorePool:
+    r"""Keeps a bounded number of stores open, for when there are too many of them.
+
+    Stores are opened on demand, and kept open in LRU order.
+    When there are too many, the least recently used ones are closed,
+    and committed first if they were modified.  At most one `AtomicStore`
+    exists per path and pool, and only one thread at a time can use it.
+
+    Instances can be used as context managers, which call `close()` upon exiting.
+
+    Attributes
+    ----------
+    max_stores : int
+        How many stores to keep open at most.  Defaults to 128.
+    max_bytes : None or int
+        If set, also limits the total size of the files of all open stores.
+        Note that this is only a rough indication of the memory used.
+    open_kwargs : dict
+        Keyword arguments for `atomic_store.open`.  The `default` value is
+        copied for each missing file, so no two stores share the same object.
+
+    See also
+    --------
+    open_store
+    """
+    def __init__(self, max_stores=128, max_bytes=None, **open_kwargs):
+        self.max_stores = max_stores
+        self.max_bytes = max_bytes
+        self.open_kwargs = open_kwargs
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._writebacks = 0
+
+    @property
+    def stats(self):
+        r"""The current `PoolStats`."""
+        with self._lock:
+            return PoolStats(self._hits, self._misses, self._evictions, self._writebacks)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    @contextlib.contextmanager
+    def open(self, path, modify=True):
+        r"""Uses the store at the given path, opening it if necessary.
+
+        Use it as a context manager, which yields an `AtomicStore`.
+        Other threads wanting the same store wait until the context is exited.
+        Note that exiting does *not* commit, unlike `atomic_store.open`:
+        The pool only commits upon eviction, `flush()`, or `close()`.
+        Of course, calling `commit()` yourself is fine, too.
+        If committing a store fails upon eviction, it simply stays open;
+        the error is raised by the next `flush()` or `close()`.
+
+        Parameters
+        ----------
+        path : str or path
+            Path to a file.  This file may or may not already exist.
+        modify : bool
+            Whether the store will need to be written back.  Default is `True`.
+        """
+        key = os.path.abspath(path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = _Entry()
+                self._entries[key] = entry
+            else:
+                self._entries.move_to_end(key)
+            entry.users += 1
+        try:
+            with entry.lock:
+                self._load(key, entry)
+                if modify:
+                    entry.dirty = True
+                yield entry.store
+        finally:
+            with self._lock:
+                entry.users -= 1
+            # Failures are reported by `flush()` and `close()`.
+            self._evict(self.max_stores)
+
+    def _load(self, key, entry):
+        if entry.store is not None:
+            with self._lock:
+                self._hits += 1
+            return
+        open_kwargs = self.open_kwargs
+        if 'default' in open_kwargs and not os.path.exists(key):
+            open_kwargs = dict(open_kwargs, default=copy.deepcopy(open_kwargs['default']))
+        entry.store = open_store(key, **open_kwargs)
+        try:
+            size = os.path.getsize(key)
+        except OSError:
+            size = 0
+        with self._lock:
+            self._misses += 1
+            self._bytes += size - entry.size
+            entry.size = size
+
+    def _is_full(self, max_stores):
+        if len(self._entries) > max_stores:
+            return True
+        return self.max_bytes is not None and self._bytes > self.max_bytes
+
+    def _evict(self, max_stores):
+        errors = dict()
+        while True:
+            with self._lock:
+                if not self._is_full(max_stores):
+                    return errors
+                victims = ((key, entry) for key, entry in self._entries.items()
+                           if entry.users == 0 and key not in errors)
+                key, entry = next(victims, (None, None))
+                if entry is None:
+                    # Everything is in use (or failing) right now; try again next time.
+                    return errors
+                # Keep it in place while writing back, so that nobody can
+                # load the file before we are done.
+                entry.users += 1
+            try:
+                with entry.lock:
+                    self._write_back(entry)
+                    entry.store = None
+            except Exception as e:
+                errors[key] = e
+            finally:
+                with self._lock:
+                    entry.users -= 1
+                    if entry.store is None:
+                        self._bytes -= entry.size
+                        entry.size = 0
+                        if entry.users == 0:
+                            del self._entries[key]
+                            self._evictions += 1
+                    else:
+                        # Don't let it block the other stores from being evicted.
+                        self._entries.move_to_end(key)
+
+    def _write_back(self, entry):
+        if entry.dirty and entry.store is not None:
+            entry.store.commit()
+            entry.dirty = False
+            with self._lock:
+                self._writebacks += 1
+
+    def flush(self):
+        r"""Commits all modified stores, but keeps them open.
+
+        Raises `WriteBackError` if some stores could not be committed,
+        after committing all the others.
+        """
+        with self._lock:
+            entries = list(self._entries.items())
+        errors = dict()
+        for key, entry in entries:
+            with entry.lock:
+                try:
+                    self._write_back(entry)
+                except Exception as e:
+                    errors[key] = e
+        if errors:
+            raise WriteBackError(errors)
+
+    def close(self):
+        r"""Commits all modified stores, and closes all stores that are not in use.
+
+        Raises `WriteBackError` if some stores could not be committed,
+        after committing all the others.  These stay open.
+        """
+        errors = self._evict(0)
+        if errors:
+            raise WriteBackError(errors)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _1, _2, _3):
+        self.close()
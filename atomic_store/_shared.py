@@ -0,0 +1,351 @@
+# Copyright (c) 2019, Ben Wiederhake
+# MIT license.  See the LICENSE file included in the package.
+# This documentation uses NumPy style.  I recommend numpydoc.
+
+import binascii
+import os
+import struct
+import sys
+import threading
+import time
+
+from ._impl import _oob_decode, _oob_encode, open_store
+
+
+# magic, sequence, st_dev, st_ino, st_size, st_mtime_ns, data segment name
+_CONTROL = struct.Struct('<8sQqqqq64s')
+_CONTROL_MAGIC = b'ASSHM\x00\x00\x01'
+_MISSING_SIGNATURE = (-1, -1, -1, -1)
+_ALIGNMENT = 64
+# How long to wait for the owner to finish updating the control segment.
+_CONTROL_ATTEMPTS = 1000
+_CONTROL_SLEEP = 0.001
+# Before Python 3.13, attaching registers the segment with the resource tracker.
+_NEEDS_UNTRACKING = os.name == 'posix' and sys.version_info < (3, 13)
+
+
+def _get_shared_memory_module(magic=[]):
+    if not magic:
+        try:
+            from multiprocessing import shared_memory
+        except ImportError:
+            raise ValueError('shared stores not supported (requires Python 3.8)')
+        magic.append(shared_memory)
+    return magic[0]
+
+
+def _create_segment(name, size):
+    return _get_shared_memory_module().SharedMemory(name, create=True, size=size)
+
+
+def _attach_segment(name):
+    shared_memory = _get_shared_memory_module()
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name, track=False)
+    segment = shared_memory.SharedMemory(name)
+    if _NEEDS_UNTRACKING:
+        # The resource tracker would delete the segment once it exits,
+        # pulling it out from under the owner.  Only the owner may delete it.
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(segment._name, 'shared_memory')
+    return segment
+
+
+def _unlink_segment(segment):
+    if _NEEDS_UNTRACKING:
+        # A forked process sharing our tracker may have unregistered it
+        # while attaching; unlinking unregisters it once more.
+        from multiprocessing import resource_tracker
+        resource_tracker.register(segment._name, 'shared_memory')
+    try:
+        segment.unlink()
+    except FileNotFoundError:
+        if _NEEDS_UNTRACKING:
+            resource_tracker.unregister(segment._name, 'shared_memory')
+
+
+def _close_segment(segment):
+    try:
+        segment.close()
+    except BufferError:
+        # Some decoded value still points into the segment.
+        return False
+    return True
+
+
+def _stat_signature(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return _MISSING_SIGNATURE
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class SharedValue:
+    r"""The value of a store, decoded once and shared by many processes.
+
+    The owning process (the one that called `share`) loads the store,
+    and publishes its value into a `multiprocessing.shared_memory` segment,
+    encoded as pickle protocol 5 with out-of-band buffers (just like
+    `OutOfBandPickleFormat`).  Other processes either inherit the object
+    by forking, or call `attach`.  Large buffers (like NumPy arrays, or
+    anything wrapped in a `memoryview`) are then always read-only
+    `memoryview` objects directly into the segment, so they exist only once
+    in RAM, and need neither parsing nor copying.  Only the small remainder
+    is unpickled in each process.
+
+    Every access to `value` compares the store file's stat signature
+    (device, inode, size, and modification time) against the one
+    that was published.  If the file changed, the owner publishes a new
+    segment.  Other processes pick it up as soon as it is published, and until
+    then load the file on their own, so they never see an outdated value.
+
+    Note that the owner only notices changes when it calls `refresh()` (or
+    reads `value`).  A pre-fork parent usually never does, so until it does,
+    every worker parses and keeps its own copy of the changed store.
+    Therefore, the owner should either call `watch()` once, or call `refresh()`
+    regularly, for example from its main loop.
+
+    Ownership and cleanup: only the process that created the `SharedValue`
+    ever unlinks segments, even if the object was inherited by forking.
+    Replaced segments are unlinked immediately, the current ones upon `close()`.
+    Other processes only ever close their own mappings.  A mapping can only be
+    closed once no decoded value points into it any more, so drop references
+    to old values before calling `close()`.
+
+    Instances can be used as context managers, which call `close()` upon exiting.
+
+    Attributes
+    ----------
+    path : str or path
+        Path to the store file.
+    name : str
+        Name of the control segment.  Pass it to `attach` in other processes.
+    open_kwargs : dict
+        Keyword arguments for `atomic_store.open`, used whenever the file is loaded.
+
+    See also
+    --------
+    share_store, attach_store
+    """
+    def __init__(self, path, name, open_kwargs, is_owner):
+        self.path = path
+        self.name = name
+        self.open_kwargs = open_kwargs
+        self._owner_pid = os.getpid() if is_owner else None
+        self._lock = threading.Lock()
+        self._lock_pid = os.getpid()
+        self._watch_stop = None
+        self._control = None
+        self._data = None
+        self._retired = []
+        self._sequence = 0
+        self._signature = None
+        self._value = None
+
+    @property
+    def is_owner(self):
+        r"""Whether this process is responsible for publishing and unlinking the segments."""
+        return self._owner_pid == os.getpid()
+
+    @property
+    def value(self):
+        r"""The current value of the store.  Checks for changes first; see `refresh()`."""
+        self.refresh()
+        return self._value
+
+    def _get_lock(self):
+        if self._lock_pid != os.getpid():
+            # Forked while some thread (e.g. the watcher) might have held it.
+            self._lock = threading.Lock()
+            self._lock_pid = os.getpid()
+        return self._lock
+
+    def watch(self, interval=1.0):
+        r"""Starts a background thread in the owner, which calls `refresh()` regularly.
+
+        This way, changes are published even if the owner never reads `value`.
+        The thread stops upon `close()`.  Calling this again has no effect.
+
+        Parameters
+        ----------
+        interval : float
+            Seconds between two checks of the file.  Defaults to 1.
+        """
+        if not self.is_owner:
+            raise ValueError('Only the owner can watch the store', self.name)
+        if self._watch_stop is not None:
+            return
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                try:
+                    self.refresh()
+                except Exception:
+                    # The workers load the file themselves meanwhile,
+                    # and thus see the error.
+                    pass
+
+        self._watch_stop = stop
+        threading.Thread(target=run, name='atomic_store watch ' + self.name, daemon=True).start()
+
+    def refresh(self):
+        r"""Makes sure that `value` reflects the current content of the store file.
+
+        In the owner, this publishes a new segment if the file changed.
+        Elsewhere, this switches to the most recently published segment,
+        or loads the file directly if the owner has not caught up yet.
+        """
+        with self._get_lock():
+            signature = _stat_signature(self.path)
+            if self.is_owner:
+                if signature != self._signature:
+                    self._publish(signature)
+                return
+            self._follow()
+            if signature != self._signature:
+                self._value = open_store(self.path, **self.open_kwargs).value
+                self._signature = signature
+
+    def _publish(self, signature):
+        # Stat before loading: If the file changes in between,
+        # the next refresh merely publishes once more.
+        value = open_store(self.path, **self.open_kwargs).value
+        size, chunks = _oob_encode(value, _ALIGNMENT)
+        sequence = self._sequence + 2
+        data = _create_segment('{}_{}'.format(self.name, sequence), size)
+        for offset, chunk in chunks:
+            data.buf[offset:offset + len(chunk)] = chunk
+        # Seqlock: An odd sequence number means the control segment is being written.
+        buf = self._control.buf
+        struct.pack_into('<Q', buf, 8, sequence - 1)
+        _CONTROL.pack_into(buf, 0, _CONTROL_MAGIC, sequence - 1, *signature, data.name.encode())
+        struct.pack_into('<Q', buf, 8, sequence)
+        self._switch(data, sequence, signature)
+
+    def _read_control(self):
+        buf = self._control.buf
+        for _ in range(_CONTROL_ATTEMPTS):
+            magic, sequence, *signature, name = _CONTROL.unpack_from(buf, 0)
+            if magic != _CONTROL_MAGIC:
+                raise ValueError('Not a shared atomic_store segment', self.name)
+            if sequence % 2 == 0 and struct.unpack_from('<Q', buf, 8)[0] == sequence:
+                return sequence, tuple(signature), name.rstrip(b'\x00').decode()
+            time.sleep(_CONTROL_SLEEP)
+        raise TimeoutError('Control segment stuck mid-update (did the owner die?)', self.name)
+
+    def _follow(self):
+        missing = None
+        while True:
+            sequence, signature, data_name = self._read_control()
+            if sequence in (self._sequence, missing, 0):
+                # If the published segment is gone, `refresh` falls back to the file.
+                return
+            try:
+                data = _attach_segment(data_name)
+            except FileNotFoundError:
+                # Maybe already replaced by an even newer one.
+                missing = sequence
+                continue
+            self._switch(data, sequence, signature)
+            return
+
+    def _switch(self, data, sequence, signature):
+        # Writable views would let one process corrupt the value for everyone.
+        self._value = _oob_decode(data.buf, readonly=True)
+        old = self._data
+        self._data = data
+        self._sequence = sequence
+        self._signature = signature
+        if old is not None:
+            if self.is_owner:
+                _unlink_segment(old)
+            self._retired.append(old)
+        self._retired = [segment for segment in self._retired if not _close_segment(segment)]
+
+    def close(self):
+        r"""Releases all segments, and unlinks them if this is the owner."""
+        if self._watch_stop is not None and self.is_owner:
+            self._watch_stop.set()
+        with self._get_lock():
+            self._value = None
+            segments = [self._data, self._control]
+            if self.is_owner:
+                for segment in segments:
+                    if segment is not None:
+                        _unlink_segment(segment)
+            for segment in segments + self._retired:
+                if segment is not None:
+                    _close_segment(segment)
+            self._data = None
+            self._control = None
+            self._retired = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _1, _2, _3):
+        self.close()
+
+
+def share_store(path, name=None, **kwargs):
+    r"""Loads a store, and publishes its value in shared memory.
+
+    Call this once in the parent process of a pre-fork worker pool,
+    before forking.  The workers can then use the inherited object,
+    or, if they were not forked, call `attach` with the same `name`.
+    Call `watch()` on the result, unless the parent calls `refresh()` on its own.
+    For more details, see `SharedValue`.
+
+    Parameters
+    ----------
+    path : str or path
+        Path to a file.  This file may or may not already exist.
+    name : None or str
+        Name of the control segment.  By default, a random name is chosen.
+    kwargs
+        Forwarded to `atomic_store.open`, for example `format` or `default`.
+
+    Returns
+    -------
+    SharedValue
+        The shared value, owned by this process.
+    """
+    if name is None:
+        name = 'as_' + binascii.hexlify(os.urandom(6)).decode()
+    if len(name.encode()) > 40:
+        raise ValueError('Name too long for a shared memory segment', name)
+    shared = SharedValue(path, name, kwargs, True)
+    shared._control = _create_segment(name, _CONTROL.size)
+    _CONTROL.pack_into(shared._control.buf, 0, _CONTROL_MAGIC, 0, *_MISSING_SIGNATURE, b'')
+    try:
+        shared.refresh()
+    except BaseException:
+        shared.close()
+        raise
+    return shared
+
+
+def attach_store(path, name, **kwargs):
+    r"""Attaches to a value published by `share` in another process.
+
+    Parameters
+    ----------
+    path : str or path
+        Path to the same file that was passed to `share`.
+    name : str
+        The `name` of the `SharedValue` returned by `share`.
+    kwargs
+        Forwarded to `atomic_store.open`, in case the file must be loaded
+        directly.  Should be the same as for `share`.
+
+    Returns
+    -------
+    SharedValue
+        The shared value, not owned by this process.
+    """
+    shared = SharedValue(path, name, kwargs, False)
+    shared._control = _attach_segment(name)
+    shared.refresh()
+    return shared
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# Copyright (c) 2019, Ben Wiederhake
+# MIT license.  See the LICENSE file included in the package.
+"""Load generator for many concurrent users of the same stores.
+
+Spawns several processes, each running several threads.  Every thread
+repeatedly opens a randomly chosen store, reads it, and sometimes modifies
+and commits it.  Afterwards, the stores are checked for lost updates.
+
+Run `python -m atomic_store.tests.contention --help` from a source checkout
+for the knobs.  The tests are not part of the installed package.
+"""
+
+import argparse
+import multiprocessing
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+import atomic_store
+
+
+def _make_value(counter, payload_size):
+    return dict(counter=counter, check=-counter, payload='x' * payload_size)
+
+
+def _is_intact(value, payload_size):
+    try:
+        return value['check'] == -value['counter'] and len(value['payload']) == payload_size
+    except (KeyError, TypeError):
+        return False
+
+
+def _run_thread(paths, cycles, write_ratio, payload_size, open_kwargs, rng, result):
+    for _ in range(cycles):
+        path = rng.choice(paths)
+        wants_write = rng.random() < write_ratio
+        start = time.perf_counter()
+        try:
+            store = atomic_store.open(path, default=_make_value(0, payload_size), **open_kwargs)
+        except Exception:
+            # A half-written or otherwise unreadable file is exactly what
+            # atomic writes promise to prevent.
+            result['torn_reads'] += 1
+            continue
+        if not _is_intact(store.value, payload_size):
+            result['torn_reads'] += 1
+            continue
+        if wants_write:
+            store.value = _make_value(store.value['counter'] + 1, payload_size)
+            try:
+                store.commit()
+            except OSError:
+                result['errors'] += 1
+                continue
+            result['writes'] += 1
+        else:
+            result['reads'] += 1
+        result['latencies'].append(time.perf_counter() - start)
+
+
+def _run_process(args):
+    index, paths, threads, cycles, write_ratio, payload_size, open_kwargs, seed = args
+    results = []
+    workers = []
+    for thread_index in range(threads):
+        result = dict(reads=0, writes=0, errors=0, torn_reads=0, latencies=[])
+        rng = random.Random('{}/{}/{}'.format(seed, index, thread_index))
+        worker = threading.Thread(target=_run_thread, args=(
+            paths, cycles, write_ratio, payload_size, open_kwargs, rng, result))
+        results.append(result)
+        workers.append(worker)
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    merged = dict(reads=0, writes=0, errors=0, torn_reads=0, latencies=[])
+    for result in results:
+        for key, value in result.items():
+            merged[key] += value
+    return merged
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def run(processes=4, threads=4, cycles=100, stores=1, write_ratio=0.5,
+        payload_size=1000, directory=None, seed=0, **open_kwargs):
+    r"""Runs the load generator, and returns a report.
+
+    Parameters
+    ----------
+    processes : int
+        Number of processes to spawn.
+    threads : int
+        Number of threads per process.
+    cycles : int
+        Number of open/read(/modify/commit) cycles per thread.
+    stores : int
+        Number of distinct store files all threads compete for.
+    write_ratio : float
+        Probability that a cycle modifies and commits the store.
+    payload_size : int
+        Size of a filler string in each store, to make reads and writes more expensive.
+    directory : None or str
+        Where to put the store files.  By default, a fresh temporary
+        directory is used and removed afterwards.
+    seed : any
+        Seed for choosing stores and operations.
+    open_kwargs
+        Forwarded to `atomic_store.open`, for example `format='pickle'`.
+
+    Returns
+    -------
+    dict
+        Counts of `reads`, `writes`, `errors` (failed commits) and `torn_reads`
+        (unreadable or inconsistent values), the number of `lost_updates`
+        (successful commits that were overwritten by a concurrent writer)
+        and their `lost_update_rate`, the wall-clock `duration`,
+        the `throughput` in cycles per second, and latency percentiles
+        `p50`, `p90`, `p99` and `max` in seconds.
+    """
+    own_directory = directory is None
+    if own_directory:
+        directory = tempfile.mkdtemp(prefix='atomic_store_contention_')
+    try:
+        paths = ['{}/store_{}'.format(directory, i) for i in range(stores)]
+        jobs = [(index, paths, threads, cycles, write_ratio, payload_size, open_kwargs, seed)
+                for index in range(processes)]
+        start = time.perf_counter()
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.map(_run_process, jobs)
+        duration = time.perf_counter() - start
+        final_counters = [atomic_store.open(path, default=dict(counter=0), **open_kwargs).value['counter']
+                          for path in paths]
+    finally:
+        if own_directory:
+            shutil.rmtree(directory)
+
+    report = dict(reads=0, writes=0, errors=0, torn_reads=0)
+    latencies = []
+    for result in results:
+        latencies.extend(result.pop('latencies'))
+        for key, value in result.items():
+            report[key] += value
+    latencies.sort()
+    report['lost_updates'] = report['writes'] - sum(final_counters)
+    report['lost_update_rate'] = report['lost_updates'] / report['writes'] if report['writes'] else 0.0
+    report['duration'] = duration
+    report['throughput'] = len(latencies) / duration
+    for name, fraction in [('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0)]:
+        report[name] = _percentile(latencies, fraction)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--cycles', type=int, default=100)
+    parser.add_argument('--stores', type=int, default=1)
+    parser.add_argument('--write-ratio', type=float, default=0.5)
+    parser.add_argument('--payload-size', type=int, default=1000)
+    parser.add_argument('--directory', default=None)
+    parser.add_argument('--seed', default=0)
+    parser.add_argument('--format', default=None, help="For example 'json' or 'pickle'")
+    args = parser.parse_args(argv)
+    report = run(processes=args.processes, threads=args.threads, cycles=args.cycles,
+                 stores=args.stores, write_ratio=args.write_ratio,
+                 payload_size=args.payload_size, directory=args.directory,
+                 seed=args.seed, format=args.format)
+    print('cycles:     {} reads, {} writes, {} failed commits'.format(
+        report['reads'], report['writes'], report['errors']))
+    print('throughput: {:.1f} cycles/s over {:.2f} s'.format(report['throughput'], report['duration']))
+    if report['p50'] is not None:
+        print('latency:    p50 {:.2f} ms, p90 {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms'.format(
+            *(1000 * report[name] for name in ['p50', 'p90', 'p99', 'max'])))
+    print('lost:       {} updates ({:.1%} of writes)'.format(
+        report['lost_updates'], report['lost_update_rate']))
+    print('torn reads: {}'.format(report['torn_reads']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+# Copyright (c) 2019, Ben Wiederhake
+# MIT license.  See the LICENSE file included in the package.
+
+import unittest
+
+from . import contention
+
+
+class TestContention(unittest.TestCase):
+    def test_smoke(self):
+        report = contention.run(processes=2, threads=2, cycles=10, stores=2, payload_size=10)
+        self.assertEqual(40, report['reads'] + report['writes'] + report['errors'] + report['torn_reads'])
+        self.assertEqual(0, report['torn_reads'])
+        self.assertGreaterEqual(report['lost_updates'], 0)
+        self.assertLessEqual(report['lost_updates'], report['writes'])
+        self.assertLessEqual(report['p50'], report['max'])
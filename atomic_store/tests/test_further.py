@@ -1,6 +1,8 @@
+import pickle
 import sys
 import unittest
 
+from .. import _impl
 from . import metastore
 
 
@@ -20,3 +22,81 @@ class TestJsonOrder(metastore.TestStore):
             store.value['zz'] = -1
             store.value['fancy'] = 3
         self.assertFile('{"b": 1337, "a": 2, "c": 42, "zz": -1, "fancy": 3}')
+
+
+@unittest.skipIf(pickle.HIGHEST_PROTOCOL < 5, 'Out-of-band buffers need pickle protocol 5')
+class TestOutOfBandPickle(metastore.TestStore):
+    def test_roundtrip(self):
+        self.setUpStore(default=dict(), format='pickle5')
+        self.assertFile(None)
+        with self.open_store() as store:
+            store.value['ro'] = pickle.PickleBuffer(b'spanish inquisition')
+            store.value['rw'] = pickle.PickleBuffer(bytearray(b'Caerbannog'))
+            store.value['inline'] = [b'shrubbery', 42]
+        with open(self.store_path, 'rb') as fp:
+            content = fp.read()
+        self.assertIn(b'spanish inquisition', content)
+        self.assertEqual(0, content.index(b'spanish inquisition') % 64)
+        store = self.open_store()
+        self.assertIsInstance(store.value['ro'], memoryview)
+        self.assertTrue(store.value['ro'].readonly)
+        self.assertEqual(b'spanish inquisition', store.value['ro'])
+        self.assertFalse(store.value['rw'].readonly)
+        self.assertEqual(b'Caerbannog', store.value['rw'])
+        self.assertEqual([b'shrubbery', 42], store.value['inline'])
+        # Writing to the copy-on-write mapping must not touch the file:
+        store.value['rw'][0:1] = b'X'
+        self.assertFile(content)
+
+    def test_memoryview_survives_commit(self):
+        self.setUpStore(default=dict(), format='pickle5')
+        with self.open_store() as store:
+            store.value['blob'] = memoryview(b'shrubbery')
+        with self.open_store() as store:
+            self.assertIsInstance(store.value['blob'], memoryview)
+            store.value['other'] = memoryview(bytearray(b'Ni!'))
+        store = self.open_store()
+        self.assertEqual(b'shrubbery', store.value['blob'])
+        self.assertTrue(store.value['blob'].readonly)
+        self.assertEqual(b'Ni!', store.value['other'])
+        self.assertFalse(store.value['other'].readonly)
+
+    def test_rejects_other_files(self):
+        self.setUpStore(default=None, format='pickle5')
+        with open(self.store_path, 'wb') as fp:
+            fp.write(pickle.dumps('not out-of-band', protocol=5) + bytes(64))
+        with self.assertRaises(ValueError):
+            self.open_store()
+
+
+class TestReflink(metastore.TestStore):
+    def test_roundtrip(self):
+        # Whether or not the filesystem supports reflinks, the result must be the same.
+        self.setUpStore(default=[], reflink=True)
+        self.assertFile(None)
+        with self.open_store() as store:
+            store.value.append('x' * 10000)
+        self.assertFile('["' + 'x' * 10000 + '"]')
+        with self.open_store() as store:
+            store.value[0] = 'x' * 5000 + 'y' + 'x' * 4999
+            store.value.append('shrubbery')
+        self.assertFile('["' + 'x' * 5000 + 'y' + 'x' * 4999 + '", "shrubbery"]')
+        with self.open_store() as store:
+            store.value = ['short']
+        self.assertFile('["short"]')
+
+    def test_binary_roundtrip(self):
+        self.setUpStore(default=dict(), format='pickle', reflink=True)
+        with self.open_store() as store:
+            store.value['blob'] = bytes(20000)
+        with self.open_store() as store:
+            self.assertEqual({'blob': bytes(20000)}, store.value)
+
+    def test_changed_blocks(self):
+        self.setUpStore()
+        old = b'a' * 10000
+        new = b'a' * 5000 + b'b' + b'a' * 3000
+        with open(self.store_path, 'w+b') as fp:
+            fp.write(old)
+            self.assertEqual(1, _impl._write_changed_blocks(fp, new, block_size=1000))
+        self.assertFile(new)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# Copyright (c) 2019, Ben Wiederhake
+# MIT license.  See the LICENSE file included in the package.
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import atomic_store
+
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class TestOpenMany(unittest.TestCase):
+    def setUp(self):
+        self.temp_prefix = tempfile.mkdtemp(prefix='test_atomic_store_')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_prefix)
+
+    def path(self, name):
+        return os.path.join(self.temp_prefix, name)
+
+    def write(self, name, content):
+        with open(self.path(name), 'w') as fp:
+            fp.write(content)
+
+    def test_order_defaults_and_errors(self):
+        self.write('a', '["a"]')
+        self.write('broken', '["unfinished')
+        self.write('c', '{"c": 3}')
+        os.mkdir(self.path('directory'))
+        names = ['a', 'missing', 'broken', 'c', 'directory', 'other_missing']
+        stores, errors = atomic_store.open_many([self.path(name) for name in names], default=[])
+        self.assertEqual(len(names), len(stores))
+        self.assertEqual(['a'], stores[0].value)
+        self.assertEqual([], stores[1].value)
+        self.assertIsNone(stores[2])
+        self.assertEqual({'c': 3}, stores[3].value)
+        self.assertIsNone(stores[4])
+        self.assertEqual([], stores[5].value)
+        # Each store gets its own default.
+        self.assertIsNot(stores[1].value, stores[5].value)
+        self.assertEqual({self.path('broken'), self.path('directory')}, set(errors))
+        self.assertIsInstance(errors[self.path('broken')], ValueError)
+        # The stores work just like those from `atomic_store.open`.
+        with stores[1] as store:
+            store.value.append('new')
+        with open(self.path('missing'), 'r') as fp:
+            self.assertEqual('["new"]', fp.read())
+
+    def test_process_pool(self):
+        self.write('small', '"small"')
+        self.write('large', '"' + 'x' * 1000 + '"')
+        self.write('broken', '"' + 'x' * 1000)
+        names = ['small', 'large', 'missing', 'broken']
+        stores, errors = atomic_store.open_many([self.path(name) for name in names],
+                                                process_threshold=100, default='default')
+        self.assertEqual(['small', 'x' * 1000, 'default', None],
+                         [store and store.value for store in stores])
+        self.assertEqual([self.path('broken')], list(errors))
+
+    def test_binary(self):
+        with atomic_store.open(self.path('p'), format='pickle') as store:
+            store.value = {'rabbit': b'Caerbannog' * 100}
+        stores, errors = atomic_store.open_many([self.path('p')], format='pickle', process_threshold=0)
+        self.assertEqual({}, errors)
+        self.assertEqual({'rabbit': b'Caerbannog' * 100}, stores[0].value)
+
+    def test_default_copied_only_when_missing(self):
+        class Uncopyable:
+            def __deepcopy__(self, memo):
+                raise TypeError('Cannot copy this')
+
+        self.write('a', '["a"]')
+        stores, errors = atomic_store.open_many([self.path('a'), self.path('missing')],
+                                                default=Uncopyable())
+        self.assertEqual(['a'], stores[0].value)
+        self.assertEqual([self.path('missing')], list(errors))
+
+    def test_positional_arguments_rejected(self):
+        with self.assertRaises(TypeError):
+            atomic_store.open_many([self.path('a')], {})
+
+    def test_broken_process_pool(self):
+        # Code from stdin can't be imported by the processes, so they all die.
+        self.write('large', '"' + 'x' * 1000 + '"')
+        script = 'import atomic_store, sys\n' \
+            'stores, errors = atomic_store.open_many([sys.argv[1]], process_threshold=0)\n' \
+            'print(len(stores[0].value), errors)\n'
+        pythonpath = os.pathsep.join(filter(None, [PACKAGE_ROOT, os.environ.get('PYTHONPATH')]))
+        output = subprocess.check_output([sys.executable, '-', self.path('large')], input=script.encode(),
+                                         env=dict(os.environ, PYTHONPATH=pythonpath),
+                                         stderr=subprocess.DEVNULL, timeout=60)
+        self.assertEqual('1000 {}', output.decode().strip())
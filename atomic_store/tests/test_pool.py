@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# Copyright (c) 2019, Ben Wiederhake
+# MIT license.  See the LICENSE file included in the package.
+
+import os.path
+import shutil
+import tempfile
+import threading
+import unittest
+
+import atomic_store
+
+
+class TestStorePool(unittest.TestCase):
+    def setUp(self):
+        self.temp_prefix = tempfile.mkdtemp(prefix='test_atomic_store_')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_prefix)
+
+    def path(self, name):
+        return os.path.join(self.temp_prefix, name)
+
+    def read(self, name):
+        with open(self.path(name), 'r') as fp:
+            return fp.read()
+
+    def test_lru_and_writeback(self):
+        pool = atomic_store.StorePool(max_stores=2, default=[])
+        with pool.open(self.path('a')) as store:
+            store.value.append('a')
+        with pool.open(self.path('b')) as store:
+            store.value.append('b')
+        # Nothing is written yet, and both stores got their own default.
+        self.assertFalse(os.path.exists(self.path('a')))
+        with pool.open(self.path('a'), modify=False) as store:
+            self.assertEqual(['a'], store.value)
+        with pool.open(self.path('c')) as store:
+            store.value.append('c')
+        # 'b' was least recently used, so it got evicted and written back.
+        self.assertEqual('["b"]', self.read('b'))
+        self.assertFalse(os.path.exists(self.path('a')))
+        self.assertEqual(atomic_store.PoolStats(hits=1, misses=3, evictions=1, writebacks=1), pool.stats)
+        self.assertEqual(2, len(pool))
+        with pool.open(self.path('b')) as store:
+            self.assertEqual(['b'], store.value)
+        pool.close()
+        self.assertEqual('["a"]', self.read('a'))
+        self.assertEqual('["c"]', self.read('c'))
+        self.assertEqual(0, len(pool))
+
+    def test_clean_stores_are_not_written(self):
+        with atomic_store.StorePool(max_stores=1) as pool:
+            with pool.open(self.path('a'), modify=False):
+                pass
+            with pool.open(self.path('b'), modify=False):
+                pass
+        self.assertFalse(os.path.exists(self.path('a')))
+        self.assertFalse(os.path.exists(self.path('b')))
+        self.assertEqual(0, pool.stats.writebacks)
+
+    def test_max_bytes(self):
+        with atomic_store.open(self.path('big'), default='x' * 1000):
+            pass
+        pool = atomic_store.StorePool(max_bytes=500)
+        with pool.open(self.path('big'), modify=False) as store:
+            # In use, so it must not be evicted yet.
+            with pool.open(self.path('small')) as small:
+                small.value = 'small'
+            self.assertEqual('x' * 1000, store.value)
+        self.assertEqual(0, len(pool))
+        self.assertEqual(2, pool.stats.evictions)
+
+    def test_flush(self):
+        pool = atomic_store.StorePool(default=0)
+        with pool.open(self.path('a')) as store:
+            store.value = 42
+        pool.flush()
+        self.assertEqual('42', self.read('a'))
+        self.assertEqual(1, len(pool))
+
+    def test_threads_share_one_instance(self):
+        pool = atomic_store.StorePool(max_stores=1, default=0)
+        paths = [self.path('a'), self.path('b')]
+
+        def work(index):
+            for i in range(100):
+                with pool.open(paths[(index + i) % 2]) as store:
+                    store.value += 1
+
+        threads = [threading.Thread(target=work, args=(index,)) for index in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        pool.close()
+        self.assertEqual(400, int(self.read('a')) + int(self.read('b')))
+
+    def test_failing_writeback(self):
+        pool = atomic_store.StorePool(max_stores=1, default=0)
+        broken = self.path('no_such_directory/broken')
+        with pool.open(broken) as store:
+            store.value = 'lost?'
+        for name in ['a', 'b', 'c']:
+            # Must neither raise, nor let the pool grow without bounds.
+            with pool.open(self.path(name)) as store:
+                store.value = name
+            self.assertLessEqual(len(pool), 2)
+        with self.assertRaises(atomic_store.WriteBackError) as cm:
+            pool.close()
+        self.assertEqual([broken], list(cm.exception.errors))
+        self.assertIsInstance(cm.exception.errors[broken], OSError)
+        self.assertEqual('"c"', self.read('c'))
+        # The failed store is still there, with its value.
+        self.assertEqual(1, len(pool))
+        with pool.open(broken, modify=False) as store:
+            self.assertEqual('lost?', store.value)
+        with self.assertRaises(atomic_store.WriteBackError):
+            pool.flush()
+
+    def test_default_copied_only_when_missing(self):
+        class Uncopyable:
+            def __deepcopy__(self, memo):
+                raise TypeError('Cannot copy this')
+
+        with atomic_store.open(self.path('a'), default='a'):
+            pass
+        pool = atomic_store.StorePool(default=Uncopyable())
+        with pool.open(self.path('a'), modify=False) as store:
+            self.assertEqual('a', store.value)
+        with self.assertRaises(TypeError):
+            with pool.open(self.path('missing')):
+                pass
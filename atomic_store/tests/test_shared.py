@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# Copyright (c) 2019, Ben Wiederhake
+# MIT license.  See the LICENSE file included in the package.
+
+import os
+import subprocess
+import sys
+import time
+import unittest
+
+import atomic_store
+from .. import _shared
+from . import metastore
+
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+ATTACH_SCRIPT = '''
+import sys
+import atomic_store
+shared = atomic_store.attach(sys.argv[1], sys.argv[2], format='pickle5')
+print(bytes(shared.value['blob']).decode())
+'''
+
+
+@unittest.skipIf(sys.version_info < (3, 8), 'Shared memory needs Python 3.8')
+class TestShared(metastore.TestStore):
+    def setUp(self):
+        self.setUpStore(default=dict(), format='pickle5')
+
+    def write(self, value):
+        with self.open_store() as store:
+            store.value = value
+        # Make sure the stat signature changes, even on coarse filesystem clocks.
+        st = os.stat(self.store_path)
+        os.utime(self.store_path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+
+    def test_missing_file(self):
+        with atomic_store.share(self.store_path, default=['default']) as shared:
+            self.assertTrue(shared.is_owner)
+            self.assertEqual(['default'], shared.value)
+            with atomic_store.attach(self.store_path, shared.name, default=['default']) as view:
+                self.assertFalse(view.is_owner)
+                self.assertEqual(['default'], view.value)
+
+    def test_share_and_refresh(self):
+        self.write({'blob': memoryview(b'spanish inquisition'), 'n': 1})
+        owner = atomic_store.share(self.store_path, format='pickle5')
+        view = atomic_store.attach(self.store_path, owner.name, format='pickle5')
+        value = view.value
+        self.assertEqual(1, value['n'])
+        self.assertIsInstance(value['blob'], memoryview)
+        self.assertTrue(value['blob'].readonly)
+        self.assertEqual(b'spanish inquisition', value['blob'])
+        del value
+
+        # The owner has not noticed the change yet, so the view loads the file itself.
+        self.write({'n': 2})
+        self.assertEqual({'n': 2}, view.value)
+        # Now the owner publishes, and the view switches over.
+        self.assertEqual({'n': 2}, owner.value)
+        self.assertEqual({'n': 2}, view.value)
+        self.assertEqual(owner._sequence, view._sequence)
+
+        view.close()
+        owner.close()
+        with self.assertRaises(FileNotFoundError):
+            atomic_store.attach(self.store_path, owner.name)
+
+    def attach_in_subprocess(self, name):
+        pythonpath = os.pathsep.join(filter(None, [PACKAGE_ROOT, os.environ.get('PYTHONPATH')]))
+        env = dict(os.environ, PYTHONPATH=pythonpath)
+        return subprocess.check_output([sys.executable, '-c', ATTACH_SCRIPT, self.store_path, name],
+                                       env=env, timeout=60).decode().strip()
+
+    def test_attach_from_other_process(self):
+        self.write({'blob': memoryview(b'Caerbannog')})
+        with atomic_store.share(self.store_path, format='pickle5') as owner:
+            # The segments must survive the exit of a process that was not forked.
+            self.assertEqual('Caerbannog', self.attach_in_subprocess(owner.name))
+            self.assertEqual('Caerbannog', self.attach_in_subprocess(owner.name))
+            self.assertEqual(b'Caerbannog', owner.value['blob'])
+
+    def test_buffers_are_readonly(self):
+        self.write({'blob': memoryview(bytearray(b'abc'))})
+        with atomic_store.share(self.store_path, format='pickle5') as owner:
+            with atomic_store.attach(self.store_path, owner.name, format='pickle5') as view:
+                value = view.value
+                self.assertTrue(value['blob'].readonly)
+                with self.assertRaises(TypeError):
+                    value['blob'][0:1] = b'X'
+                self.assertTrue(owner.value['blob'].readonly)
+                self.assertEqual(b'abc', owner.value['blob'])
+                del value
+
+    def test_stuck_control_segment(self):
+        with atomic_store.share(self.store_path, format='pickle5') as owner:
+            with atomic_store.attach(self.store_path, owner.name, format='pickle5') as view:
+                # As if the owner died in the middle of publishing.
+                sequence = owner._sequence
+                owner._control.buf[8:16] = (sequence + 1).to_bytes(8, 'little')
+                attempts, _shared._CONTROL_ATTEMPTS = _shared._CONTROL_ATTEMPTS, 5
+                try:
+                    with self.assertRaises(TimeoutError):
+                        view.refresh()
+                finally:
+                    _shared._CONTROL_ATTEMPTS = attempts
+                    owner._control.buf[8:16] = sequence.to_bytes(8, 'little')
+
+    def test_watch(self):
+        self.write({'n': 1})
+        with atomic_store.share(self.store_path, format='pickle5') as owner:
+            with atomic_store.attach(self.store_path, owner.name, format='pickle5') as view:
+                sequence = view._sequence
+                owner.watch(0.01)
+                self.write({'n': 2})
+                # Without anyone touching `owner.value`, the watcher publishes.
+                deadline = time.monotonic() + 10
+                while owner._sequence == sequence and time.monotonic() < deadline:
+                    time.sleep(0.01)
+                self.assertEqual({'n': 2}, view.value)
+                self.assertNotEqual(sequence, view._sequence)
+
+    def test_name_too_long(self):
+        with self.assertRaises(ValueError):
+            atomic_store.share(self.store_path, name='x' * 100)